@@ -128,7 +128,7 @@ def into_networkx_tree(filtration, aggregated_scens, probas): # (filtration: lis
     return(G)
 
 
-def full_reduction(H, G, method='LP', Pi=np.zeros((2,2)), iterations=7, keep_track=True,npool=1, rank=0, delta=1000):
+def full_reduction(H, G, method='LP', Pi=None, iterations=7, keep_track=True,npool=1, rank=0, delta=1000):
     # """
     #
     # :param H: Initial tree that needs to be reduced
@@ -136,7 +136,7 @@ def full_reduction(H, G, method='LP', Pi=np.zeros((2,2)), iterations=7, keep_tra
     # :param method: (str) the method to compute the : can be -'Kovacevic' (use LP to compute the barycenter)[see Nested reductionfrom Kovacevic and Pichler],
     #                                                         -'MAM' [see the Method of averaged marginales from Mimouni et al.],
     #                                                         -'IBP' it will use IBP and Snkhorn [see Peyré's work],
-    # :param Pi: The optimal transport matrix between the trees G and H can be initialized with another method, if not it is set as zero.
+    # :param Pi: The optimal transport matrix between the trees G and H can be initialized with another method, if not it is set as None.
     # :return:
     # G: the approximate tree
     # l_tps: the computation time of the reduction method for the probabilities only
@@ -150,7 +150,7 @@ def full_reduction(H, G, method='LP', Pi=np.zeros((2,2)), iterations=7, keep_tra
     start = time.time()
     l_tps = []
     l_G = []
-    Pi = 0
+    Pi = None
     ND_aprx_precedent = 0
     record_t_n = []
     for iter in range(iterations):
@@ -30,35 +30,26 @@ def LP_reduction_nt(c,b):
     # Objective function
     R = c.shape[0]
     c = np.reshape(c, (R * sumS,))
+    # the variables are x[j * sumS + i] = Pi[j, i]
+    variables = np.arange(R * sumS)
+    j_x, i_x = np.divmod(variables, sumS)
 
     # Building A: Constraint (right sum of Pi to get p)
-    A = eye(sumS)
-    A = hstack([A] * R)
+    rows = [i_x]
+    columns = [variables]
+    values = [np.ones(R * sumS)]
 
     # IF WE COMPUTE A BARYCENTER = IF THERE IS SEVERAL PARENTS = IF M != 0
     if len(S) > 1:
-        # Building B: Constraint (left sum of Pi are equal)
-        # lines indices:
-        shape_B = ((M - 1), sumS)
-        # indices values
-        indices_values_B = np.append(np.ones(S[0]), - np.ones(S[1]))
-        # lines indices:
-        line_indices_B = np.linspace(0, S[0] + S[1] - 1, S[0] + S[1])
-        # column indices:
-        column_indices_B = np.zeros(S[0] + S[1])
-        index = 0
-        for m in range(1, M - 1):
-            indices_values_B = np.append(indices_values_B, np.append(np.ones(S[m]), - np.ones(S[m + 1])))
-            index = index + S[m - 1]
-            line_indices_B = np.append(line_indices_B, np.linspace(0, S[m] + S[m + 1] - 1, S[m] + S[m + 1]) + index)
-            column_indices_B = np.append(column_indices_B, np.ones(S[m] + S[m + 1]) * m)
-        # Building one small matrix
-        B = csc_matrix((indices_values_B, (column_indices_B, line_indices_B)), shape_B)
-
-        # Using Kronecker product to get the total matrix
-        B = kron(eye(R), B)
-        # Building A_eq = concatenate((A, B), axis=0)
-        A_eq = vstack([A, B])
+        # Building B: Constraint (left sum of Pi are equal): for each j and each m < M-1, the sum of Pi[j, i] over the
+        # children i of m minus the sum over the children i of m+1 is null, on the line sumS + j * (M-1) + m
+        m_x = np.repeat(np.arange(M), S)[i_x]
+        plus = m_x < M - 1
+        minus = m_x > 0
+        rows.extend([sumS + j_x[plus] * (M - 1) + m_x[plus], sumS + j_x[minus] * (M - 1) + m_x[minus] - 1])
+        columns.extend([variables[plus], variables[minus]])
+        values.extend([np.ones(np.sum(plus)), - np.ones(np.sum(minus))])
+        nb_constraints = sumS + R * (M - 1)
         # b_eq:
         b = np.concatenate(b)
         b_eq = np.append(b, np.zeros(R * (M - 1)))
@@ -68,12 +59,17 @@ def LP_reduction_nt(c,b):
         # the sum of the Pi[j,i|0,0] for all i and all j = 1
         # Indeed, note that the constraint 2 of (21) cannot be applied because there is only one parent (list_m=[0]), but we know
         # that sum_j ( sum_i Pi[j,i|0,0] ) = sum_j P'(j|0) = sum_j P'(j) = 1
-        B = np.ones((1,R * sumS))
-        # Building A_eq = concatenate((A, B), axis=0)
-        A_eq = vstack([A, B])
+        rows.append(np.full(R * sumS, sumS))
+        columns.append(variables)
+        values.append(np.ones(R * sumS))
+        nb_constraints = sumS + 1
         # b_eq:
         b_eq = np.append(b, 1)
 
+    # Building A_eq = concatenate((A, B), axis=0), directly in the csc format used by HiGHS
+    A_eq = csc_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                      shape=(nb_constraints, R * sumS))
+
     # Resolution: with the bound x >= 0
     res = scipy.optimize.linprog(c, A_eq=A_eq, b_eq=b_eq, bounds=(0,None), method='highs')  # bounds=(0,None): the Pi cannot be negatif
 
@@ -9,6 +9,7 @@ In this version of IBP I kept only the bare minimum to make the algorithm the fa
 """
 import time
 import numpy as np
+from numba import njit, prange
 
 
 def barycenter_IBP(b, M_dist, computation_time=500, iterations_min=100, iterations_max=100000, lambda_sinkhorn=20,
@@ -103,6 +104,99 @@ def barycenter_IBP(b, M_dist, computation_time=500, iterations_min=100, iteratio
     return (p, Pi) #, P, l_time, Time, Precision, iteration_IBP)
 
 
+def barycenter_IBP_batch(q, offsets, M_dists, iterations_min=100, iterations_max=100000, lambda_sinkhorn=20,
+                         precision=10 ** -4):
+    """
+    Input:
+    *q: (S x 1) the n probability distributions, stacked: the distribution m is q[offsets[m]:offsets[m + 1]]
+    *offsets: (n + 1) bounds of the distributions in q
+    *M_dists: list of K (R_k x S) distance matrices, one barycenter problem is solved for each of them
+    *lambda_sinkhorn: (float) regularization parameter
+    *iterations_min, iterations_max: (int) bounds on the number of iterations of each problem
+    *precision: (float) stopping criterion of each problem
+
+    Output:
+    *Pi: list of K (R_k x S) transport plans, stacked with regard to the distributions: (Pi_1 | Pi_2 | ...)
+
+    Infos:
+    This function solves the same barycenter problem as barycenter_IBP for several distance matrices sharing the
+    same distributions. The problems are solved in parallel, in the log domain so that the kernel exp(-lambda M) does
+    not underflow. The criterion on the computation time is not used: iterations_max bounds each problem.
+    """""
+    # I should divide M_dist by the max to get it normalized:
+    logK = []
+    for M_dist in M_dists:
+        max_D = np.max(M_dist)
+        logK.append(- lambda_sinkhorn * (M_dist / max_D if max_D > 0 else M_dist))
+    row_ptr = np.cumsum([0] + [M_dist.shape[0] for M_dist in M_dists])
+    with np.errstate(divide='ignore'):
+        logq = np.log(q)
+
+    Pi = _log_IBP_batch(np.concatenate(logK, axis=0), row_ptr, logq, np.asarray(offsets), iterations_min,
+                        iterations_max, precision)
+    return np.split(Pi, row_ptr[1:-1])
+
+
+@njit(cache=True)
+def _logsumexp(a):
+    max_a = np.max(a)
+    if max_a == -np.inf:
+        return max_a
+    return max_a + np.log(np.sum(np.exp(a - max_a)))
+
+
+@njit(cache=True)
+def _log_IBP_iteration(logK, logU, logq, offsets, logV, logUKv):
+    # Get V = Q / (K.T @ U), each column i of K only belongs to the support of one distribution m
+    R = logK.shape[0]
+    M = len(offsets) - 1
+    for m in range(M):
+        for i in range(offsets[m], offsets[m + 1]):
+            logV[i] = logq[i] - _logsumexp(logK[:, i] + logU[:, m])
+    # Get UKv = U * (K @ V):
+    for j in range(R):
+        for m in range(M):
+            logUKv[j, m] = logU[j, m] + _logsumexp(logK[j, offsets[m]:offsets[m + 1]] + logV[offsets[m]:offsets[m + 1]])
+    # Get U = U * exp(mean(log(UKv))) / UKv and the precision
+    Vprecision = 0.
+    for j in range(R):
+        mean_log = np.mean(logUKv[j])
+        for m in range(M):
+            logU[j, m] += mean_log - logUKv[j, m]
+        Vprecision += np.std(np.exp(logUKv[j]))
+    return Vprecision
+
+
+@njit(parallel=True, cache=True)
+def _log_IBP_batch(logK, row_ptr, logq, offsets, iterations_min, iterations_max, precision):
+    S = logK.shape[1]
+    M = len(offsets) - 1
+    Pi = np.zeros_like(logK)
+    for k in prange(len(row_ptr) - 1):
+        lK = logK[row_ptr[k]:row_ptr[k + 1]]
+        R = lK.shape[0]
+        logV = np.empty(S)
+        logUKv = np.empty((R, M))
+        # Initialization: the first update starts from U = 1
+        logU = np.zeros((R, M))
+        _log_IBP_iteration(lK, logU, logq, offsets, logV, logUKv)
+
+        # Loop:
+        iteration_IBP = 0
+        Vprecision = np.inf
+        while (iteration_IBP < iterations_min) or (iteration_IBP < iterations_max and Vprecision > precision):
+            iteration_IBP = iteration_IBP + 1
+            Vprecision = _log_IBP_iteration(lK, logU, logq, offsets, logV, logUKv)
+
+        # find the transport plans Pi[j, i] = U[j, m] K[j, i] V[i] where i is in the support of the distribution m
+        for m in range(M):
+            for i in range(offsets[m], offsets[m + 1]):
+                logV[i] = logq[i] - _logsumexp(lK[:, i] + logU[:, m])
+                for j in range(R):
+                    Pi[row_ptr[k] + j, i] = np.exp(logU[j, m] + lK[j, i] + logV[i])
+    return Pi
+
+
 
 
 
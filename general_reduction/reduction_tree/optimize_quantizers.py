@@ -5,6 +5,7 @@ Implementation of the gradiant descent to improve the quantizers of trees in cas
 """
 
 import numpy as np
+from scipy.sparse import issparse
 
 def optim_quantizers(H, G, Pi):
     """
@@ -14,7 +15,7 @@ def optim_quantizers(H, G, Pi):
     :param H: Initial tree
     :param G: Approximated tree structure: only the filtration and the quantifiers are necessary
     H and G must have the same number of stages
-    :param Pi: Transport matrix between H and G, this can be derived using one of the 3 algorithms 'tree_reduction---'
+    :param Pi: Transport matrix between H and G (dense or sparse), this can be derived using one of the 3 algorithms 'tree_reduction---'
     :return:
     G the approximated tree updated with better quantizers
     """
@@ -25,18 +26,20 @@ def optim_quantizers(H, G, Pi):
     ancestor_m = [i for i in H.nodes if H.nodes[i]['stage']==T]
     for t in range(T,-1,-1):
         # we go recursively from stage T-1 to stage 0, identifying each time the ancestors of the treated nodes
-        list_m = set(ancestor_m)
-        list_n = set(ancestor_n)
+        list_m = list(set(ancestor_m))
+        list_n = list(set(ancestor_n))
         ancestor_m = []
         ancestor_n = []
-        for n in list_n:
+        # block of the transport matrix between the nodes of the stage t
+        Pi_t = Pi[list_n][:, list_m]
+        if issparse(Pi_t):
+            Pi_t = Pi_t.toarray()
+        for i_n, n in enumerate(list_n):
             den = 0
             num = 0
-            for m in list_m:
-                a = H.nodes[m]['quantizer']
-                b = Pi[n,m]
-                den = den + Pi[n,m] * H.nodes[m]['quantizer']
-                num = num + Pi[n,m]
+            for i_m, m in enumerate(list_m):
+                den = den + Pi_t[i_n, i_m] * H.nodes[m]['quantizer']
+                num = num + Pi_t[i_n, i_m]
 
                 # I collect the ancestor of node m for next step
                 if t > 0:
@@ -118,6 +118,10 @@ def distance_GH(G,H):
                 nodesH.append(aj[j][-1])
 
 
+    # The probabilities of the children of each node are read once from the trees
+    weights_children_G = {m: np.array([G[m][i]['weight'] for i in G.successors(m)]) for m in G.nodes}
+    weights_children_H = {n: np.array([H[n][i]['weight'] for i in H.successors(n)]) for n in H.nodes}
+
     ## I. METHOD THAT KEEPS THE TREE STRUCTURE
     # Nodes of the stage T-1: so we start the recursivity with them
     list_m = [i for i in G.nodes if G.nodes[i]['stage']==T-1]
@@ -133,7 +137,7 @@ def distance_GH(G,H):
         splitting_work = division_tasks(len(list_m), pool_size)
         for work in splitting_work[rank]:
             m = list(list_m)[work]
-            outputs[m] = _loop_n(t, G, H, list_n, nodesH, nodesG, D_ij, m)
+            outputs[m] = _loop_n(t, G, H, weights_children_G, weights_children_H, list_n, nodesH, nodesG, D_ij, m)
 
         l_outputs = comm.gather(outputs, root=0)
         if rank == 0:
@@ -156,7 +160,7 @@ def distance_GH(G,H):
     Time = time.time()-start
     return(D_ij[0,0], D_ij, Time)
 
-def _loop_n(t, G, H, list_n, nodesH, nodesG, D_ij, m):
+def _loop_n(t, G, H, weights_children_G, weights_children_H, list_n, nodesH, nodesG, D_ij, m):
     ancestor_m = []
     ancestor_n = []
     D_ij_t = np.zeros(len(list_n))
@@ -168,8 +172,8 @@ def _loop_n(t, G, H, list_n, nodesH, nodesG, D_ij, m):
         children_mj = [i for i in range(len(nodesG)) if nodesG[i] in children_m]
 
         # Constraint on p and q
-        p = np.array([G[m][i]['weight'] for i in children_m])
-        q = np.array([H[n][i]['weight'] for i in children_n])
+        p = weights_children_G[m]
+        q = weights_children_H[n]
 
         # Distance matrix
         c = D_ij[children_mj, :]
@@ -5,10 +5,16 @@ proposed in 'Tree approximation for discrete time stochastic process: a process
 """
 import sys
 import time
+import hashlib
+from collections import OrderedDict
 # Multiprocessing
 from functools import partial
 from multiprocessing import Pool
 from mpi4py import MPI
+import networkx as nx
+from scipy.spatial.distance import cdist
+from scipy.sparse import csr_matrix
+from numba import njit
 # my codes
 from reduction_tree.MAM import *  # my implementation of MAM, that computes the barycenter between probability densities
 from reduction_tree.MAM_MPI import *
@@ -16,8 +22,13 @@ from reduction_tree.barycenter_IBP import *
 from reduction_tree.LP_tree_reduction import *
 from reduction_tree.find_process_data import *
 
+# Transport plans of the subtree problems already solved: identical problems (same probabilities and same weighted
+# distance matrices) often appear in wide trees, they are only solved once. Least recently used plans are dropped first.
+_subtree_cache = OrderedDict()
+_subtree_cache_size = 4096
 
-def reduction_tree(H, G, Pi=np.zeros((2, 2)), rho=1000, method='LP', lambda_IBP=25, npool=1):
+
+def reduction_tree(H, G, Pi=None, rho=1000, method='LP', lambda_IBP=25, npool=1, dtype=np.float32):
     comm = MPI.COMM_WORLD
     rank = 0 # comm.Get_rank()
     pool_size = 1 #
@@ -26,19 +37,24 @@ def reduction_tree(H, G, Pi=np.zeros((2, 2)), rho=1000, method='LP', lambda_IBP=
     :param H: Initial tree
     :param G: Approximated tree structure: only the filtration and the quantifiers are necessary
     H and G must have the same number of stages
-    :param Pi: Initialize the transport matrix between two tree
+    :param Pi: Initialize the transport matrix between two tree (dense or sparse), if None it is initialized uniformly
+    from the conditional probabilities of H
     :param method: Method to compute the barycenter problem : LP, MAM, IBP
+    :param dtype: precision of the distance and transport matrices, float32 is enough for the precision 10**-4 of the
+    barycenter problems and the 3 decimals of the probabilities of G
 
     :return:
     * G : an approximated tree of H obtained from a rewritting of 'Tree approximation for discrete time stochastic process:
     a process distance approach' from Kovacevic and Pichler taking advantage of the barycenter LP problem that enables to
     use the Method of Averaged Marginals (MAM) to solve the Linear Program
     * D_ij : the distance matrix between all nodes of H and G. Note that D_ij[0,0] is the nested distance betwen H and G.
-    * Pi : the transport matrix between G and H
+    * Pi : the transport matrix between G and H, as a sparse csr_matrix: only nodes of the same stage are coupled
     * time_tot: total time in second to compute the reduction
     """
 
     assert method in ['LP', 'MAM', 'IBP']
+    assert dtype in [np.float32, np.float64]
+    mpi_dtype = MPI.FLOAT if dtype == np.float32 else MPI.DOUBLE
     # Time management
     start = time.time()
 
@@ -48,40 +64,35 @@ def reduction_tree(H, G, Pi=np.zeros((2, 2)), rho=1000, method='LP', lambda_IBP=
     # Note that this difference is also due to the approximation of the iterative Pi_hat from the initialization to the end
     epsilon = 10 ** -3
 
+    ## STRUCTURE OF THE TREES: computed once, so that the graphs are not browsed again at each stage
+    # number of stages
+    T = np.max([G.nodes[i]['stage'] for i in G.nodes])
+    stage_nodes_G, children_G, parent_G, position_G = tree_tables(G, T)[:-1]
+    stage_nodes_H, children_H, parent_H, position_H, weights_children_H = tree_tables(H, T)
+    # conditional probabilities of the children of each node of the original tree
+
     ## INITIALIZATION OF PI: this is needed because the recursive computation is based on the previous iteration,
     # therefore at iteration 0 it is based on the initialization
     # I build recursively the transport matrix thanks to the probabilities of the initial tree
+    # Pi is only non null between nodes of the same stage, so it is stored by blocks: Pi_stage[t][k, l] is the
+    # transport between the nodes stage_nodes_G[t][k] and stage_nodes_H[t][l]
     N1 = len(G.nodes)  # nb of nodes in G
     N2 = len(H.nodes)  # nb of nodes in H
-    if np.sum(Pi) == 0:
-        Pi = np.zeros((N1, N2))
-        Pi[0, 0] = 1
-        # number of stages
-        T = np.max([G.nodes[i]['stage'] for i in G.nodes])
-        # Nodes of the stage T-1: so we start the recursivity with them
-        ancestor_n = [i for i in G.nodes if G.nodes[i]['stage'] == T - 1]  # list_n = set(ancestor_n) follows
-        ancestor_m = [i for i in H.nodes if H.nodes[i]['stage'] == T - 1]
+    if Pi is None:
+        Pi_stage = [np.zeros((len(stage_nodes_G[t]), len(stage_nodes_H[t])), dtype=dtype) for t in range(T + 1)]
+        Pi_stage[0][0, 0] = 1
         for t in range(T - 1, -1, -1):
-            # we go recursively from stage T-1 to stage 0, identifying each time the ancestors of the treated nodes
-            list_m = set(ancestor_m)
-            list_n = set(ancestor_n)
-            ancestor_m = []
-            ancestor_n = []
-            for n in list_n:
-                for m in list_m:
-                    # Children of nodes n and m
-                    children_n = [i for i in G.successors(n)]
-                    children_m = [i for i in H.successors(m)]
-
+            # every node of the stage t is the ancestor of a node of the stage t+1
+            for n in stage_nodes_G[t]:
+                # Children of node n
+                children_n = position_G[children_G[n]]
+                for m in stage_nodes_H[t]:
                     # I uniformly fill the transport matrix using the constraint on the conditional proba of the original tree
-                    for i in children_m:
-                        for j in children_n:
-                            Pi[j, i] = H[m][i]['weight'] / len(children_n)
-
-                    # I collect the ancestor of nodes n and m
-                    if t > 0:
-                        ancestor_n.append([i for i in G.predecessors(n)][0])
-                        ancestor_m.append([i for i in H.predecessors(m)][0])
+                    Pi_stage[t + 1][np.ix_(children_n, position_H[children_H[m]])] = \
+                        weights_children_H[m][None, :] / len(children_n)
+    else:
+        Pi = csr_matrix(Pi)
+        Pi_stage = [Pi[stage_nodes_G[t]][:, stage_nodes_H[t]].toarray().astype(dtype) for t in range(T + 1)]
 
     ## INITAILIZATION OF THE DISTANCE MATRIX : exact process distance between the leaves
     # Distance matrix initialization
@@ -89,200 +100,340 @@ def reduction_tree(H, G, Pi=np.zeros((2, 2)), rho=1000, method='LP', lambda_IBP=
 
     ai, wi, pi, T = find_process_data(G)
     aj, wj, pj = find_process_data(H)[:-1]
-    # Using Euclidean distance
+    # Using Euclidean distance: each row of Wi (resp. Wj) is the flattened process of a leaf of G (resp. H)
     leaves_G = len(ai)
     leaves_H = len(aj)
-    nodesG = []
-    nodesH = []
-    D_ij = np.zeros((leaves_G, leaves_H))
-    for i in range(leaves_G):
-        nodesG.append(ai[i][-1])
-        for j in range(leaves_H):
-            D_ij[i, j] = np.sum((wi[i] - wj[j]) ** 2)
-            if i == 0:
-                nodesH.append(aj[j][-1])
+    nodesG = [a[-1] for a in ai]
+    nodesH = [a[-1] for a in aj]
+    Wi = np.stack(wi).reshape((leaves_G, -1))
+    Wj = np.stack(wj).reshape((leaves_H, -1))
+    D_ij = cdist(Wi, Wj, 'sqeuclidean').astype(dtype)
+    # position of each node in the rows (resp. columns) of D_ij
+    pos_G = {node: i for i, node in enumerate(nodesG)}
+    pos_H = {node: j for j, node in enumerate(nodesH)}
 
     ## OPTIMIZATION OF THE PROBABILITIES
     # Nodes of the stage T-1: so we start the recursivity with them
-    ancestor_m = [i for i in H.nodes if H.nodes[i]['stage'] == T - 1]
-    ancestor_n = [i for i in G.nodes if G.nodes[i]['stage'] == T - 1]
+    ancestor_m = stage_nodes_H[T - 1]
+    ancestor_n = stage_nodes_G[T - 1]
     record_t_n = []
     nb_n = []
     nb_m = []
     for t in range(T - 1, -1, -1):
         starttime = time.time()
         # we go recursively from stage T-1 to stage 0, identifying each time the ancestors of the treated nodes
-        list_m = set(ancestor_m)
-        list_n = set(ancestor_n)
+        nodes_m = np.unique(np.asarray(ancestor_m))
+        nodes_n = np.unique(np.asarray(ancestor_n))
+
+        # children of all the nodes m, in the order the transport plans Pi_k_cat are stacked, the columns of the
+        # subtree at node m (index i_m) are offsets[i_m]:offsets[i_m + 1]
+        all_children_m = np.concatenate([children_H[m] for m in nodes_m])
+        offsets = np.cumsum([0] + [len(children_H[m]) for m in nodes_m])
+        # transport between the nodes n and m of the stage t, from the initialization/previous iteration
+        Pi_t = Pi_stage[t][np.ix_(position_G[nodes_n], position_H[nodes_m])]
+
+        # The nodes n with a single child are trivial: the transport plans are the probabilities of the children of
+        # the nodes m, only the other nodes are solved (and divided between the ranks)
+        nb_children_n = np.array([len(children_G[n]) for n in nodes_n])
+        solve_work = np.flatnonzero(nb_children_n > 1)
+        trivial_work = np.flatnonzero(nb_children_n == 1)
+
+        # The outputs of the nodes n are stored in a single buffer, the nodes to solve first: the packet of node n
+        # (index i_n) is out_buf[start_n[i_n]:start_n[i_n] + size_n[i_n]], Pi_k_cat (|children_n| x |all_children_m|)
+        # followed by D_ij_t (|nodes_m|)
+        order = np.concatenate((solve_work, trivial_work))
+        size_n = nb_children_n * len(all_children_m) + len(nodes_m)
+        acc_size = np.concatenate(([0], np.cumsum(size_n[order])))
+        start_n = np.empty(len(nodes_n), dtype=np.int64)
+        start_n[order] = acc_size[:-1]
+        out_buf = np.empty(acc_size[-1], dtype=dtype)
+
+        # every rank fills the (cheap) packets of the trivial nodes at once: the clipped and normalized
+        # probabilities, and the corresponding local distances
+        if len(trivial_work) > 0:
+            trivial_buf = out_buf[acc_size[len(solve_work)]:].reshape((len(trivial_work), -1))
+            b_cat = np.maximum(np.concatenate([weights_children_H[m] for m in nodes_m]), epsilon)
+            b_cat /= np.repeat(np.add.reduceat(b_cat, offsets[:-1]), np.diff(offsets))
+            children_ni = [pos_G[children_G[n][0]] for n in nodes_n[trivial_work]]
+            children_mj = [pos_H[i] for i in all_children_m]
+            trivial_buf[:, :len(all_children_m)] = b_cat
+            trivial_buf[:, len(all_children_m):] = np.add.reduceat(D_ij[np.ix_(children_ni, children_mj)] * b_cat,
+                                                                   offsets[:-1], axis=1)
 
         # Parrallel work using MPI:
-        outputs = {}
-        splitting_work = division_tasks(len(list_n), pool_size)
-        for work in splitting_work[rank]:
-            n = list(list_n)[work]
-            outputs[n] = _loop_subtree_n(t, G, H, nodesG, nodesH, list_m, D_ij, Pi,
-                            method, lambda_IBP, rho, epsilon, pool_sizeMAM, n)
+        counts_n, displs_n = division_tasks(len(solve_work), pool_size)
+        local_work = solve_work[displs_n[rank]:displs_n[rank] + counts_n[rank]]
+        costs = {}
+        Pi_ibp = {}
+        if method == 'IBP':
+            # the barycenter problems of the nodes n share the probabilities b: they are solved together
+            solved_work = local_work
+            for work in solved_work:
+                costs[work] = _subtree_n_costs(children_G[nodes_n[work]], children_H, pos_G, pos_H, nodes_m, offsets,
+                                               D_ij, Pi_t[work])
+            b_cat = np.concatenate([weights_children_H[m] for m in nodes_m])
+            keys = {work: subtree_key(method, lambda_IBP, b_cat, offsets, costs[work][1]) for work in solved_work}
+            # only one problem per key that is not already solved
+            unsolved = {}
+            for work in solved_work:
+                Pi_ibp[work] = subtree_cache_get(keys[work])
+                if Pi_ibp[work] is None:
+                    unsolved.setdefault(keys[work], work)
+            if len(unsolved) > 0:
+                Pi_batch = barycenter_IBP_batch(b_cat, offsets, [costs[work][1] for work in unsolved.values()],
+                                                iterations_min=10, iterations_max=200, lambda_sinkhorn=lambda_IBP,
+                                                precision=10 ** -4)
+                Pi_batch = dict(zip(unsolved.keys(), Pi_batch))
+                for key in unsolved:
+                    subtree_cache_put(key, Pi_batch[key])
+                for work in solved_work:
+                    if Pi_ibp[work] is None:
+                        Pi_ibp[work] = Pi_batch[keys[work]].copy()
+        for work in local_work:
+            _loop_subtree_n(t, children_G, children_H, weights_children_H, pos_G, pos_H, nodes_m, D_ij, Pi_t[work],
+                            method, lambda_IBP, rho, epsilon, pool_sizeMAM, nodes_n[work],
+                            out_buf[start_n[work]:start_n[work] + size_n[work]], costs=costs.get(work),
+                            Pi_k_cat=Pi_ibp.get(work))
 
         if pool_size > 1:
-            l_outputs = comm.gather(outputs, root=0)
-            if rank == 0:
-                for dico in l_outputs:
-                    for key in dico.keys():
-                        outputs[key] = dico[key]
-            outputs = comm.bcast(outputs, root=0)
-
-        Pi_k = {}
-        D_ij_t = []
-        ancestor_n = []
-        for i_n, n in enumerate(list_n):
-            Pi_k[n] = outputs[n]["Pi_k"]
-            D_ij_t.append(outputs[n]["D_ij_t"])
-            ancestor_n.extend(outputs[n]["ancestor_n"])
-            if i_n == 0:
-                ancestor_m = outputs[n]["ancestor_m"]
-
-            children_n = [j for j in G.successors(n)]
-            for i_m, m in enumerate(list_m):
-                children_m = [i for i in H.successors(m)]
-                # FILL the transport matrix with the conditional probabilities
-                # when the whole tree is treated, I will use (23) from 'Tree approximation for discrete time stochastic process:
-                # a process distance approach' from Kovacevic and Pichler to build the Pi(i,j)
-                for j_c, j in enumerate(children_n):
-                    Pi[j, children_m] = Pi_k[n][i_m][j_c, :]  # transport plan between subtree at node n and subtree at node m(index i_m)
-
-                    # FILL the probabilities in the approximated tree
-                    # I uniformly fill the transport matrix using the constraint on the conditional proba of the original tree
-                    # I don't need to go through every nodes of a stage of the original tree, only one is sufficient:
-                    if i_m == 0:
-                        G[n][j]['weight'] = np.sum(Pi[j, children_m])
-                        # sum_Gj = sum_Gj + np.abs(G[n][j]['weight'])
-                        G[n][j]['weight'] = np.round(G[n][j]['weight'], 3)
-
-        nodesG, nodesH = list(list_n), list(list_m)
-        D_ij = np.array(D_ij_t)
-        record_t_n.append(np.round(time.time()-starttime, 4)) #/len(list_n))
-        nb_m.append(len(list_m))
-        nb_n.append(len(list_n))
+            # The shapes of the outputs are known by every rank thanks to the tree structures, so only the values of
+            # the packets are exchanged, each rank filling its own part of out_buf
+            displs = acc_size[displs_n]
+            counts = acc_size[displs_n + counts_n] - displs
+            comm.Allgatherv(MPI.IN_PLACE, [out_buf[:acc_size[len(solve_work)]], counts, displs, mpi_dtype])
+
+        # distance matrix between the nodes n and m for the next step
+        D_ij_next = np.empty((len(nodes_n), len(nodes_m)), dtype=dtype)
+        # I collect the ancestors of the nodes n and m for next step
+        ancestor_n = [parent_G[n] for n in nodes_n] if t > 0 else []
+        ancestor_m = [parent_H[m] for m in nodes_m] if t > 0 else []
+        for i_n, n in enumerate(nodes_n):
+            size_Pi = start_n[i_n] + size_n[i_n] - len(nodes_m)
+            Pi_k_cat = out_buf[start_n[i_n]:size_Pi].reshape((len(children_G[n]), len(all_children_m)))
+            D_ij_next[i_n] = out_buf[size_Pi:start_n[i_n] + size_n[i_n]]
+
+            # FILL the transport matrix with the conditional probabilities
+            # when the whole tree is treated, I will use (23) from 'Tree approximation for discrete time stochastic process:
+            # a process distance approach' from Kovacevic and Pichler to build the Pi(i,j)
+            children_n = children_G[n]
+            # transport plans between subtree at node n and subtrees at nodes m
+            Pi_stage[t + 1][np.ix_(position_G[children_n], position_H[all_children_m])] = Pi_k_cat
+
+            # FILL the probabilities in the approximated tree
+            # I don't need to go through every nodes of a stage of the original tree, only one is sufficient:
+            weights = np.sum(Pi_k_cat[:, :offsets[1]], axis=1, dtype=np.float64)
+            np.round(weights, 3, out=weights)
+            for j_c, j in enumerate(children_n):
+                G[n][j]['weight'] = weights[j_c]
+
+        nodesG, nodesH = nodes_n, nodes_m
+        pos_G = {node: i for i, node in enumerate(nodesG)}
+        pos_H = {node: j for j, node in enumerate(nodesH)}
+        D_ij = D_ij_next
+        record_t_n.append(np.round(time.time()-starttime, 4)) #/len(nodes_n))
+        nb_m.append(len(nodes_m))
+        nb_n.append(len(nodes_n))
 
     # REBUILD the updated Transport matrix between trees H and G
-    # Exact method:
-    Pi[0, 0] = 1
-    list_i1 = [i for i in H.nodes if H.nodes[i]['stage'] == 1]
-    list_j1 = [i for i in G.nodes if G.nodes[i]['stage'] == 1]
+    # Exact method: each node has a single parent, so going down stage by stage the product over the ancestors is
+    # Pi[j1, i1] = Pi[j1, i1|n, m] * Pi[n, m] where n and m are the parents of j1 and i1
+    Pi_stage[0][0, 0] = 1
     for t in range(1, T + 1):
-        for i1 in list_i1:
-            ancestor_m = [i for i in H.predecessors(i1)]
-            for j1 in list_j1:
-                ancestor_n = [j for j in G.predecessors(j1)]
-                for m in ancestor_m:
-                    for n in ancestor_n:
-                        Pi[j1, i1] = Pi[j1, i1] * Pi[n, m]
-        list_i1 = [i for i in H.nodes if H.nodes[i]['stage'] == t + 1]
-        list_j1 = [i for i in G.nodes if G.nodes[i]['stage'] == t + 1]
+        n = position_G[parent_G[stage_nodes_G[t]]]
+        m = position_H[parent_H[stage_nodes_H[t]]]
+        Pi_stage[t] *= Pi_stage[t - 1][np.ix_(n, m)]
+    # the blocks are gathered in the sparse transport matrix between trees H and G
+    rows = np.concatenate([np.repeat(stage_nodes_G[t], len(stage_nodes_H[t])) for t in range(T + 1)])
+    columns = np.concatenate([np.tile(stage_nodes_H[t], len(stage_nodes_G[t])) for t in range(T + 1)])
+    values = np.concatenate([Pi_stage[t].ravel() for t in range(T + 1)])
+    Pi = csr_matrix((values, (rows, columns)), shape=(N1, N2))
 
     # Time management:
     time_tot = time.time() - start
     # Output
     # D_ij[0,0] is the approached Nested distance
-    return (G, D_ij[0,0], Pi,record_t_n[::-1], nb_n[::-1], nb_m[::-1], time_tot)
+    return (G, np.float64(D_ij[0,0]), Pi,record_t_n[::-1], nb_n[::-1], nb_m[::-1], time_tot)
 
 
-def _loop_subtree_n(t, G, H, nodesG, nodesH, list_m, D_ij, Pi, method, lambda_IBP, rho, epsilon,pool_sizeMAM, n):
-    ancestor_m = []
-    ancestor_n = []
-    D_ij_t = np.zeros(len(list_m))
-    b = []  # list of probabilities
-    c = {}  # distance matrix with the ponderations
-    children_n = [j for j in G.successors(n)]
-    children_ni = [j for j in range(len(nodesG)) if nodesG[j] in children_n]
-    dist_matrices = []
+def _subtree_n_costs(children_n, children_H, pos_G, pos_H, list_m, offsets, D_ij, Pi_n):
+    """
+    This function builds the distance matrices between the subtree at node n and the subtrees at nodes m
+    :param children_n: children of the node n
+    :param offsets: the columns of the subtree at node m (index i_m) are offsets[i_m]:offsets[i_m + 1]
+    :param Pi_n: Pi[n, m] for every m of list_m, from the initialization/previous iteration
+    :return:
+    dist_cat: distance matrices between the children of n and the children of the nodes m, stacked with regard to m
+    c_cat: the same distance matrices weighted by Pi[n, m]
+    """
+    children_ni = np.fromiter((pos_G[j] for j in children_n), dtype=np.intp, count=len(children_n))
+    # rows of the distance matrix for the children of n, shared by every m
+    Dn = np.ascontiguousarray(np.take(D_ij, children_ni, axis=0))
+    dist_cat = np.empty((len(children_n), offsets[-1]), dtype=D_ij.dtype)
+    c_cat = np.empty((len(children_n), offsets[-1]), dtype=D_ij.dtype)
 
     # go through each node and treat the subtree (node + its children)
     for i_m, m in enumerate(list_m):
         # Children of nodes m
-        children_m = [i for i in H.successors(m)]
-        children_mj = [i for i in range(len(nodesH)) if nodesH[i] in children_m]
-
-        # Constraint on p (b is the list of the source probabilities)
-        p = np.array([H[m][i]['weight'] for i in children_m])
-        b.append(p)
+        children_mj = np.fromiter((pos_H[i] for i in children_H[m]), dtype=np.intp, count=len(children_H[m]))
 
         # Distance matrix
-        dist = D_ij[children_ni, :]
-        dist = dist[:, children_mj]
-        dist_matrices.append(dist)
+        block = slice(offsets[i_m], offsets[i_m + 1])
+        dist_cat[:, block] = np.take(Dn, children_mj, axis=1)
         # ponderation on the distance matrix due to the initialization/previous iteration of Pi
-        c[i_m] = dist * Pi[n, m]
-
-        # I collect the ancestor of node m for next step
-        if t > 0:
-            ancestor_m.append([i for i in H.predecessors(m)][0])
+        np.multiply(dist_cat[:, block], Pi_n[i_m], out=c_cat[:, block])
 
-    # I collect the ancestor of node n for next step
-    if t > 0:
-        ancestor_n.append([i for i in G.predecessors(n)][0])
+    # Output
+    return (dist_cat, c_cat)
+
+
+def _loop_subtree_n(t, children_G, children_H, weights_children_H, pos_G, pos_H, list_m, D_ij, Pi_n, method,
+                    lambda_IBP, rho, epsilon, pool_sizeMAM, n, out, costs=None, Pi_k_cat=None):
+    # out is the packet of node n in the output buffer, filled with Pi_k_cat followed by D_ij_t
+    # costs and Pi_k_cat can be given when the distance matrices and the transport plans are already computed
+    children_n = children_G[n]
+    # Constraint on p (b is the list of the source probabilities)
+    b = [weights_children_H[m] for m in list_m]
+    # The subtrees are stacked with regard to m, the columns of the subtree at node m (index i_m) are
+    # offsets[i_m]:offsets[i_m + 1]
+    offsets = np.cumsum([0] + [len(p) for p in b])
+    if costs is None:
+        costs = _subtree_n_costs(children_n, children_H, pos_G, pos_H, list_m, offsets, D_ij, Pi_n)
+    dist_cat, c_cat = costs
 
     # I treat the resolution of the LP as a barycenter problem, using MAM:
     # this provides the barycenter AND the transport matrices !
-    if len(children_n) == 1:
+    # The transport plans are stacked with regard to m as well: (Pi_m1[j,i|n,m1] | Pi_m2 | ...)
+    if Pi_k_cat is not None:
+        # the transport plans are given (the IBP problems of a stage are solved together by reduction_tree)
+        pass
+    elif len(children_n) == 1:
         # this is a trivial case where the subtree of the approximate tree has only one branch (1 chil at the node)
         # then directly:
-        Pi_k = [np.expand_dims(bi, axis=0) for bi in b]
+        Pi_k_cat = np.expand_dims(np.concatenate(b), axis=0)
     elif len(children_n) > 1:
+        key = subtree_key(method, rho if method == 'MAM' else lambda_IBP, np.concatenate(b), offsets, c_cat)
+        Pi_k_cat = subtree_cache_get(key)
+
+    if Pi_k_cat is None:
         if method == 'MAM':
+            c = {i_m: c_cat[:, offsets[i_m]:offsets[i_m + 1]] for i_m in range(len(b))}  # distance matrix with the ponderations
             if pool_sizeMAM > 1:
                 resMAM = MAM_MPI(b, M_dist=c, exact=False, rho=rho, keep_track=False, computation_time=10,
                              iterations_min=10, iterations_max=200, precision=10 ** -4, logs=False)
             else:
                 resMAM = MAM(b, M_dist=c, exact=False, rho=rho, keep_track=False, computation_time=10,
                              iterations_min=10, iterations_max=200, precision=10 ** -4, logs=False)
-            Pi_k = resMAM[1]
+            Pi_k_cat = np.concatenate([resMAM[1][i_m] for i_m in range(len(b))], axis=1)
 
         elif method == 'IBP':
-            # I reshape the probabilities vector as [p1,p2,p(m),0,0,0,...,0], [0,0,0,p1,p2,p(m),0,0,0,...,0] to keep one distance matrix as built in c_
-            sumS = sum(len(sublist) for sublist in b)
-            acc = 0
-            b_ = []
-            c_ = []
-            for i_m, p in enumerate(b):
-                v = np.zeros(sumS)
-                v[acc:acc + len(p)] = p
-                b_.append(v)
-                acc += len(p)
-                c_.append(c[i_m])
-            c_ = np.concatenate(c_, axis=1)
-
-            resIBP = barycenter_IBP(b_, c_, computation_time=1, iterations_min=10, iterations_max=200,
-                                    lambda_sinkhorn=lambda_IBP, precision=10 ** -4)
-            Pi_ibp = resIBP[1]
-            acc = 0
-            Pi_k = []
-            for i_m, p in enumerate(b):
-                Pi_k.append(Pi_ibp[i_m][:, acc:acc + len(p)])
-                acc += len(p)
+            Pi_k_cat = barycenter_IBP_batch(np.concatenate(b), offsets, [c_cat], iterations_min=10, iterations_max=200,
+                                            lambda_sinkhorn=lambda_IBP, precision=10 ** -4)[0]
 
         elif method == 'LP':
-            c_lp = [c[i_m] for i_m, _ in enumerate(list_m)]
-            c_lp = np.concatenate(c_lp, axis=1)
-            res_LP = LP_reduction_nt(c_lp, b)
-            Pi_lp = res_LP[0]
-            acc = 0
-            Pi_k = []
-            for p in b:
-                Pi_k.append(Pi_lp[:, acc:acc + len(p)])
-                acc += len(p)
+            res_LP = LP_reduction_nt(c_cat, b)
+            Pi_k_cat = res_LP[0]
+        subtree_cache_put(key, Pi_k_cat)
 
-    for i_m, m in enumerate(list_m):
+    # Outputs: the transport plans are written in out, then clipped and normalized there while the local distance
+    # matrix fills the rest of the packet
+    Pi_out = out[:Pi_k_cat.size].reshape(Pi_k_cat.shape)
+    Pi_out[...] = Pi_k_cat
+    clip_norm_dot(Pi_out, dist_cat, offsets, epsilon, out[Pi_k_cat.size:])
+
+
+@njit(cache=True, fastmath=True)
+def clip_norm_dot(Pi_k_cat, dist_cat, offsets, epsilon, D_ij_t):
+    """
+    This function treats the stacked transport plans of a subtree in place, in a single pass over each of them
+    :param Pi_k_cat: Conditional transport matrices, stacked with regard to m: (Pi_m1[j,i|n,m1] | Pi_m2 | ...)
+    :param dist_cat: Distance matrices between the children of n and the children of the nodes m, stacked the same way
+    :param offsets: the columns of the subtree at node m (index i_m) are offsets[i_m]:offsets[i_m + 1]
+    :param epsilon: lower bound of the transport plans
+    :param D_ij_t: filled with the local distances sum_ji Pi[j,i|n,m] * dist[j,i] for each m
+    """
+    R = Pi_k_cat.shape[0]
+    for i_m in range(len(offsets) - 1):
         # 3.3 of the article explains that Pi is not null: it is larger than a small number 'epsilon'
-        Pi_k[i_m] = Pi_k[i_m].clip(epsilon)
-        Pi_k[i_m] = Pi_k[i_m] / np.sum(Pi_k[i_m])  # The sum of all Pi[j,i|n,m] for n and m fixed is equal to 1
+        sum_Pi = 0.
+        dist = 0.
+        for j in range(R):
+            for i in range(offsets[i_m], offsets[i_m + 1]):
+                Pi_ji = max(Pi_k_cat[j, i], epsilon)
+                Pi_k_cat[j, i] = Pi_ji
+                sum_Pi += Pi_ji
+                dist += Pi_ji * dist_cat[j, i]
+        # The sum of all Pi[j,i|n,m] for n and m fixed is equal to 1
+        for j in range(R):
+            for i in range(offsets[i_m], offsets[i_m + 1]):
+                Pi_k_cat[j, i] /= sum_Pi
+        D_ij_t[i_m] = dist / sum_Pi
+
+
+def subtree_key(method, parameter, b_cat, offsets, c_cat):
+    """
+    This function identifies a subtree problem
+    :param method: method solving the problem and its parameter (rho for MAM, lambda_IBP for IBP)
+    :param b_cat: probabilities of the children of the nodes m, stacked with regard to m
+    :param offsets: the children of the node m (index i_m) are offsets[i_m]:offsets[i_m + 1]
+    :param c_cat: weighted distance matrices, stacked with regard to m
+    :return: a hash of the problem
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{method}{parameter}{c_cat.shape}{c_cat.dtype}'.encode())
+    for array in (np.asarray(offsets, dtype=np.int64), b_cat, c_cat):
+        h.update(np.ascontiguousarray(array).tobytes())
+    return h.digest()
+
 
-        # FILL the local distance matrix
-        D_ij_t[i_m] = np.sum(np.multiply(Pi_k[i_m], dist_matrices[i_m]))
+def subtree_cache_get(key):
+    # Copy of the transport plans of the problem identified by key, None if it has not been solved
+    if key not in _subtree_cache:
+        return None
+    _subtree_cache.move_to_end(key)
+    return _subtree_cache[key].copy()
 
-    # Outputs
-    return dict(Pi_k=Pi_k, D_ij_t=D_ij_t, ancestor_m=ancestor_m, ancestor_n=ancestor_n)
 
+def subtree_cache_put(key, Pi_k_cat):
+    # Save a copy of the transport plans of the problem identified by key (before clipping and normalization)
+    _subtree_cache[key] = Pi_k_cat.copy()
+    _subtree_cache.move_to_end(key)
+    if len(_subtree_cache) > _subtree_cache_size:
+        _subtree_cache.popitem(last=False)
+
+
+def tree_tables(G, T):
+    """
+    This function browses the tree once to store its structure in plain containers
+    :param G: Scenario tree where nodes (0, ..., N-1) contain a 'stage' value and links contain a 'weight'
+    :param T: number of stages of the tree
+    :return:
+    stage_nodes: list of the nodes of each stage, stage_nodes[t] are the nodes of the stage t
+    children: children[v] is the array of the children of the node v
+    parent: array of the parent of each node (the root has parent -1)
+    position: array of the index of each node in the list of the nodes of its stage
+    weights_children: weights_children[v] is the array of the probabilities of the children of the node v
+    """
+    N = len(G.nodes)
+    # CSR adjacency: the children of the node v are children_idx[children_ptr[v]:children_ptr[v + 1]]
+    adjacency = nx.to_scipy_sparse_array(G, nodelist=range(N), weight=None, format='csr')
+    children_ptr, children_idx = adjacency.indptr, adjacency.indices
+    edges_parent = np.repeat(np.arange(N), np.diff(children_ptr))
+    # the weights of the links, in the same order as children_idx
+    weights = np.fromiter((G[u][v]['weight'] for u, v in zip(edges_parent, children_idx)), dtype=np.float64,
+                          count=len(children_idx))
+    children = [children_idx[children_ptr[v]:children_ptr[v + 1]] for v in range(N)]
+    weights_children = [weights[children_ptr[v]:children_ptr[v + 1]] for v in range(N)]
+    parent = -np.ones(N, dtype=int)
+    parent[children_idx] = edges_parent
+
+    stages = np.fromiter((G.nodes[v]['stage'] for v in range(N)), dtype=int, count=N)
+    stage_nodes = [np.flatnonzero(stages == t) for t in range(T + 1)]
+    position = np.zeros(N, dtype=int)
+    for t in range(T + 1):
+        position[stage_nodes[t]] = np.arange(len(stage_nodes[t]))
+
+    # Output
+    return (stage_nodes, children, parent, position, weights_children)
 
 
 def division_tasks(nb_tasks, pool_size):
@@ -292,27 +443,14 @@ def division_tasks(nb_tasks, pool_size):
     *pool_size : number of CPU/GPU to divide the tasks between
 
     Outputs:
-    rearranged: numpy list of lists so that rearranged[i] should be treated by CPU[i] (rank=i)
+    counts: numpy array so that counts[i] is the number of tasks treated by CPU[i] (rank=i)
+    displs: numpy array so that CPU[i] treats the contiguous tasks displs[i], ..., displs[i] + counts[i] - 1
     """
-    # The tasks can be equaly divided for each CPUs
-    if nb_tasks % pool_size == 0:
-        rearranged = np.array([i for i in range(nb_tasks)])
-        rearranged = np.split(rearranged, pool_size)
-
-    # Some CPUs will receive more tasks
-    else:
-        div = nb_tasks // pool_size
-        congru = nb_tasks % pool_size
-        rearranged1 = np.array([i for i in range(div * congru + congru)])
-        rearranged1 = np.split(rearranged1, congru)
-        rearranged2 = np.array([i for i in range(div * congru + congru, nb_tasks)])
-        rearranged2 = np.split(rearranged2, pool_size - congru)
-        rearranged = rearranged1 + rearranged2
+    # The tasks are equaly divided for each CPUs, the first CPUs receive one more task if there is a remainder
+    div, congru = divmod(nb_tasks, pool_size)
+    counts = np.full(pool_size, div)
+    counts[:congru] += 1
+    displs = np.concatenate(([0], np.cumsum(counts[:-1])))
 
     # Output:
-    return (rearranged)
-
-
-
-
-
+    return (counts, displs)